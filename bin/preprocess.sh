@@ -0,0 +1,10 @@
+gpu=0
+
+preprocess() {
+    model=$1
+
+    conf=./conf/${model}.py
+    python3 ./src/cnn/main.py preprocess ${conf} --gpu ${gpu}
+}
+
+preprocess model004
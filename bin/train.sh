@@ -8,4 +8,15 @@ train() {
     python3 ./src/cnn/main.py train ${conf} --gpu ${gpu}
 }
 
-train model004
\ No newline at end of file
+# one fold per GPU, e.g. train_parallel model004 5
+train_parallel() {
+    model=$1
+    n_gpus=$2
+
+    conf=./conf/${model}.py
+    # fill the cache first: the ranks share it and would write the same entries
+    python3 ./src/cnn/main.py preprocess ${conf} --gpu ${gpu}
+    torchrun --standalone --nproc_per_node=${n_gpus} ./src/cnn/main.py train ${conf}
+}
+
+train model004
@@ -5,12 +5,19 @@ seed = 949
 
 epochs = 1000
 amp = True
+compile = True  # torch.compile the model (torch>=2.0)
+deterministic = True  # False lets cuDNN pick non-deterministic (faster) algorithms
 batch_size = 4
 num_workers = 4
 imgsize = (192, 192, 16)
+cache_dir = f"{workdir}/cache"
 
 # Inferer
 prediction_folder = f"{workdir}/output"
+inferer = dict(
+    sw_batch_size=8,
+    overlap=0.25,
+)
 checkpoints = f"{workdir}/*.pt"
 
 loss = dict(
@@ -61,17 +68,25 @@ data = dict(
     train=dict(
         imgdir='./input/train/version_3',
         imgsize=imgsize,
+        cache_dir=cache_dir,
+        # cache the label fg/bg voxel indices for the crop sampling: saves
+        # the per-sample index scan but costs 4 bytes per (mostly background)
+        # voxel, about twice the size of the train cache
+        cache_indices=False,
         batch_size=batch_size,
         loader=dict(
             shuffle=True,
             num_workers=num_workers,
             pin_memory=True,
+            # every training batch has the same shape
+            drop_last=True,
         ),
     ),
 
     valid=dict(
         imgdir='./input/train/version_3',
         imgsize=imgsize,
+        cache_dir=cache_dir,
         batch_size=1,
         loader=dict(
             shuffle=True,
@@ -83,6 +98,7 @@ data = dict(
     test=dict(
         imgdir='./input/test',
         imgsize=imgsize,
+        cache_dir=cache_dir,
         batch_size=1,
         loader=dict(
             shuffle=False,
@@ -1,19 +1,22 @@
+import os
+import inspect
 import numpy as np
 import torch
 from torch import nn
 from torch.optim import lr_scheduler
 from ignite.contrib.handlers import param_scheduler
 import monai
+from monai.data import NibabelReader
 from monai.transforms import (
     AddChanneld,
     AsDiscreted,
     CastToTyped,
+    DeleteItemsd,
+    FgBgToIndicesd,
     LoadImaged,
     Orientationd,
     RandAffined,
     RandCropByPosNegLabeld,
-    RandFlipd,
-    RandGaussianNoised,
     ScaleIntensityRanged,
     Spacingd,
     SpatialPadd,
@@ -23,35 +26,107 @@ from monai.transforms import (
 )
 from utils.logger import log
 
+# PersistentDataset only hashes the input paths: bump this whenever the
+# deterministic head of _get_xforms changes, so stale entries are not reused
+CACHE_VERSION = "v1"
 
-def _get_xforms(mode="train", keys=("image", "label"), img_size=(320, 320, 16)):
+
+class RandAffineIndicesd(RandAffined):
+    """RandAffined that drops the cached voxel indices of the label when the
+    affine is applied, so that RandCropByPosNegLabeld recomputes them.
+
+    Args:
+        keys (tuple): Keys used to perfom MONAI transforms.
+        indices_keys (tuple): Keys of the foreground/background indices.
+    """
+
+    def __init__(self, keys, indices_keys, **kwargs):
+        super().__init__(keys, **kwargs)
+        self.indices_keys = indices_keys
+
+    def __call__(self, data):
+        d = super().__call__(data)
+        if self._do_transform:
+            for key in self.indices_keys:
+                d.pop(key, None)
+        return d
+
+
+class TrustedPersistentDataset(monai.data.PersistentDataset):
+    """PersistentDataset that reads back its cache on torch>=2.6.
+
+    MONAI 0.5 calls torch.load without weights_only, which defaults to True
+    since torch 2.6 and rejects the cached numpy arrays and meta dicts. The
+    cache is written by this dataset itself, so it is loaded as trusted.
+    """
+
+    load_kwargs = (
+        {"weights_only": False}
+        if "weights_only" in inspect.signature(torch.load).parameters
+        else {}
+    )
+
+    def _cachecheck(self, item_transformed):
+        if self.cache_dir is not None:
+            data_item_md5 = self.hash_func(item_transformed).decode("utf-8")
+            hashfile = self.cache_dir / f"{data_item_md5}.pt"
+            if hashfile.is_file():
+                return torch.load(hashfile, **self.load_kwargs)
+
+        return super()._cachecheck(item_transformed)
+
+
+def _get_xforms(mode="train", keys=("image", "label"), img_size=(320, 320, 16),
+                cache_indices=False):
     """Returns a composed transform.
 
     Args:
         mode (str, optional): Mode speficied (e.g. train/test). Defaults to "train".
         keys (tuple, optional): Keys used to perfom MONAI transforms. Defaults to ("image", "label").
         img_size (tuple, optional): Spatial image size. Defaults to (320, 320, 16).
+        cache_indices (bool, optional): Cache the label foreground/background
+            voxel indices used by the crop (train only). Defaults to False.
 
     Returns:
         [monai.transforms]: Returns MONAI transforms composed.
     """
 
-    xforms = [
-        LoadImaged(keys),
+    xforms = [LoadImaged(keys[0], reader=NibabelReader(), dtype=np.float32)]
+    if len(keys) > 1:
+        # binary masks, no need to hold them as fp32
+        xforms.append(
+            LoadImaged(keys[1:], reader=NibabelReader(), dtype=np.uint8))
+
+    xforms.extend([
         AddChanneld(keys),
         Orientationd(keys, axcodes="LPS"),
         Spacingd(keys, pixdim=(1.25, 1.25, 5.0),
                  mode=("bilinear", "nearest")[: len(keys)]),
         ScaleIntensityd(keys, minv=0.0, maxv=1.0),
-    ]
+        # [0, 1] intensities survive fp16, this is what gets cached
+        CastToTyped(keys, dtype=(np.float16, np.uint8)[: len(keys)]),
+    ])
 
     if mode in ["train"]:
+        xforms.append(
+            SpatialPadd(keys, spatial_size=(img_size[0], img_size[1], -1),
+                        mode="reflect"))  # ensure at least WxD
+        indices_keys, crop_kwargs = (), {}
+        if cache_indices:
+            # foreground/background voxel indices for the crop sampling,
+            # computed once and cached with the volume
+            indices_keys = (f"{keys[1]}_fg", f"{keys[1]}_bg")
+            xforms.extend([
+                FgBgToIndicesd(keys[1], fg_postfix="_fg", bg_postfix="_bg"),
+                CastToTyped(indices_keys, dtype=np.int32),
+            ])
+            crop_kwargs = dict(fg_indices_key=indices_keys[0],
+                               bg_indices_key=indices_keys[1])
         xforms.extend(
             [
-                SpatialPadd(keys, spatial_size=(img_size[0], img_size[1], -1),
-                            mode="reflect"),  # ensure at least WxD
-                RandAffined(
+                RandAffineIndicesd(
                     keys,
+                    indices_keys=indices_keys,
                     prob=0.25,
                     # 3 parameters control the transform on 3 dimensions
                     rotate_range=(0.5, 0.5, None),
@@ -61,27 +136,53 @@ def _get_xforms(mode="train", keys=("image", "label"), img_size=(320, 320, 16)):
                 ),
                 RandCropByPosNegLabeld(keys, label_key=keys[1],
                                        spatial_size=img_size,
-                                       num_samples=3),
-                RandGaussianNoised(keys[0], prob=0.15, std=0.01),
-                RandFlipd(keys, spatial_axis=0, prob=0.5),
-                RandFlipd(keys, spatial_axis=1, prob=0.5),
-                RandFlipd(keys, spatial_axis=2, prob=0.5),
-
+                                       num_samples=3, **crop_kwargs),
+                # flips and gaussian noise are applied per batch on the GPU,
+                # see augment_batch
             ]
         )
-
-        dtype = (np.float32, np.uint8)
-
-    if mode == "val":
-        dtype = (np.float32, np.uint8)
-    if mode == "infer":
-        dtype = (np.float32,)
+        if cache_indices:
+            xforms.append(DeleteItemsd(indices_keys, allow_missing_keys=True))
+    # images stay fp16 up to the GPU, where prepare_batch upcasts them
+    # (RandAffined outputs fp32, hence the cast again after it)
+    dtype = (np.float16, np.uint8)[: len(keys)]
 
     xforms.extend([CastToTyped(keys, dtype=dtype), ToTensord(keys)])
 
     return monai.transforms.Compose(xforms)
 
 
+def augment_batch(image, label, flip_prob=0.5, noise_prob=0.15, noise_std=0.01):
+    """Random flips and gaussian noise, drawn per sample, for a whole batch.
+
+    Runs on the device of the batch, without host synchronization.
+
+    Args:
+        image (torch.Tensor): Images, (B, C, H, W, D).
+        label (torch.Tensor): Labels, (B, C, H, W, D).
+        flip_prob (float, optional): Probability to flip each spatial axis. Defaults to 0.5.
+        noise_prob (float, optional): Probability to add noise. Defaults to 0.15.
+        noise_std (float, optional): Maximum noise std. Defaults to 0.01.
+
+    Returns:
+        tuple: Augmented (image, label).
+    """
+    batch_size = image.shape[0]
+    shape = (batch_size, 1, 1, 1, 1)
+
+    for dim in (2, 3, 4):
+        flip = torch.rand(shape, device=image.device) < flip_prob
+        image = torch.where(flip, image.flip(dim), image)
+        label = torch.where(flip, label.flip(dim), label)
+
+    # same as RandGaussianNoise: std drawn uniformly in [0, noise_std)
+    std = torch.rand(shape, device=image.device) * noise_std
+    std = std * (torch.rand(shape, device=image.device) < noise_prob)
+    image = image + std * torch.randn_like(image)
+
+    return image, label
+
+
 def get_dataloader(cfg, mode, keys, data, img_size):
     """Apply the transforms and create a DataLoader.
 
@@ -96,17 +197,36 @@ def get_dataloader(cfg, mode, keys, data, img_size):
         [monai.data.DataLoader]: Returns a DataLoader
     """
     if mode == 'train':
-        transforms = _get_xforms("train", keys, img_size)
+        transforms = _get_xforms("train", keys, img_size,
+                                 cache_indices=cfg.get("cache_indices", False))
     elif mode == 'val':
         transforms = _get_xforms("val", keys, img_size)
     else:
         # Test
         transforms = _get_xforms("test", keys, img_size)
 
-    dataset = monai.data.CacheDataset(
-        data=data,
-        transform=transforms
-    )
+    if cfg.get("cache_dir"):
+        # the deterministic head (up to the first random transform) is
+        # computed once per file and read back from disk afterwards
+        dataset = TrustedPersistentDataset(
+            data=data,
+            transform=transforms,
+            cache_dir=os.path.join(
+                cfg.cache_dir,
+                f"{mode}_indices" if cfg.get("cache_indices") else mode,
+                CACHE_VERSION),
+        )
+    else:
+        dataset = monai.data.CacheDataset(
+            data=data,
+            transform=transforms
+        )
+
+    worker_kwargs = {}
+    if cfg.loader.num_workers > 0:
+        # keep the workers (and what they have read from the cache) between
+        # epochs and let each one stay a few batches ahead of the GPU
+        worker_kwargs = dict(persistent_workers=True, prefetch_factor=4)
 
     return monai.data.DataLoader(
         dataset,
@@ -115,6 +235,8 @@ def get_dataloader(cfg, mode, keys, data, img_size):
         shuffle=cfg.loader.shuffle,
         num_workers=cfg.loader.num_workers,
         pin_memory=torch.cuda.is_available(),
+        drop_last=cfg.loader.get("drop_last", False),
+        **worker_kwargs,
     )
 
     return loaders
@@ -130,9 +252,57 @@ def get_model(cfg):
         Pytorch (MONAI) model: Returns a model instance.
     """
     try:
-        return getattr(monai.networks.nets, cfg.model.name)(**cfg.model.params)
+        net = getattr(monai.networks.nets, cfg.model.name)(**cfg.model.params)
     except:
         log(f"Failed to load model. Model: {cfg.model.name}")
+        return
+
+    # NDHWC lets cuDNN run the Conv3d kernels without transposing around them
+    return net.to(memory_format=torch.channels_last_3d)
+
+
+def compile_model(cfg, net, mode="default"):
+    """Compiles the network with torch.compile if enabled (cfg.compile).
+
+    Args:
+        cfg (config file): Config file from model.
+        net (torch.nn.Module): Network to compile.
+        mode (str, optional): torch.compile mode. Defaults to "default".
+
+    Returns:
+        torch.nn.Module: The compiled network, or net unchanged.
+    """
+    if cfg.get("compile") and hasattr(torch, "compile"):
+        # fuses the norm/activation/residual epilogues around each Conv3d.
+        # "reduce-overhead" records a CUDA graph per input shape, so it only
+        # pays off where every batch has the same shape (training, with
+        # drop_last); the sliding window batches of the evaluation vary
+        # (the last one is smaller), those use the default mode
+        return torch.compile(net, mode=mode)
+
+    return net
+
+
+class MeanEnsemble(nn.Module):
+    """Averages the logits of several models in a single forward call.
+
+    Args:
+        models (list): Models to ensemble.
+    """
+
+    def __init__(self, models):
+        super().__init__()
+        self.models = nn.ModuleList(models)
+
+    def forward(self, x):
+        # accumulate in place, in fp32 so that the metrics never see fp16
+        # logits under amp, instead of stacking every model output. Always a
+        # copy: the model output may be a buffer reused by the next model
+        logits = self.models[0](x).to(torch.float32, copy=True)
+        for model in self.models[1:]:
+            logits.add_(model(x))
+
+        return logits.div_(len(self.models))
 
 
 def get_loss(cfg):
@@ -190,17 +360,18 @@ def get_scheduler(cfg, optimizer, len_loader):
         log(f"Failed to load the scheduler. Scheduler: {cfg.scheduler.name}")
 
 
-def get_inferer(patch_size):
+def get_inferer(patch_size, sw_batch_size=8, overlap=0.25):
     """Returns a sliding window inference instance
 
     Args:
         patch_size (tuple): ROI size
+        sw_batch_size (int, optional): Windows per forward pass. Defaults to 8.
+        overlap (float, optional): Overlap between windows. Defaults to 0.25.
 
     Returns:
         monai.inferes: Returns a SlidingWindowInferer.
     """
 
-    sw_batch_size, overlap = 2, 0.5
     inferer = monai.inferers.SlidingWindowInferer(
         roi_size=patch_size,
         sw_batch_size=sw_batch_size,
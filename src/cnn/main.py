@@ -1,30 +1,18 @@
 import torch
 import numpy as np
-import torch.nn as nn
 from ignite.contrib.handlers import ProgressBar
-from monai.engines import SupervisedEvaluator
-from ignite.utils import to_onehot
 from ignite.engine.events import Events
-from monai.transforms import AsDiscrete, Activations
-from monai.metrics import compute_hausdorff_distance, compute_meandice, compute_average_surface_distance
+from monai.metrics import compute_hausdorff_distance
+from monai.handlers.utils import write_metrics_reports
 from monai.handlers import (
     CheckpointSaver,
-    CheckpointLoader,
     SegmentationSaver,
     MeanDice,
     StatsHandler,
     ValidationHandler,
-    HausdorffDistance,
-    StatsHandler,
     MetricsSaver
 )
-from monai.transforms import (
-    RandGaussianNoised,
-    AsDiscreted,
-    MeanEnsembled
-)
-import pandas as pd
-import numpy as np
+from monai.transforms import AsDiscreted
 import monai
 import glob
 from utils.config import Config
@@ -32,7 +20,6 @@ from utils.logger import logger, log
 from utils.util import SplitDataset
 import os
 import sys
-from pathlib import Path
 import argparse
 import factory
 from tqdm import tqdm
@@ -52,7 +39,7 @@ def get_args():
         description="Runs the segmentation algorithm.")
 
     parser.add_argument("mode", metavar="mode", default="train",
-                        choices=("train", "test", "test-segment"),
+                        choices=("train", "test", "test-segment", "preprocess"),
                         type=str, help="mode of workflow"
                         )
     parser.add_argument("config")
@@ -63,6 +50,69 @@ def get_args():
     return parser.parse_args()
 
 
+def prepare_batch(batchdata, device=None, non_blocking=False):
+    """Move a batch to the device, images as fp32 in channels_last_3d layout.
+
+    Args:
+        batchdata (dict): Batch from the DataLoader.
+        device (torch.device, optional): Target device. Defaults to None.
+        non_blocking (bool, optional): Asynchronous copy. Defaults to False.
+
+    Returns:
+        tuple: (image, label) tensors, label is None when not available.
+    """
+    image = batchdata["image"].to(
+        device=device, non_blocking=non_blocking,
+        memory_format=torch.channels_last_3d)
+    # images are cached and copied as fp16
+    image = image.float()
+
+    label = batchdata.get("label")
+    if isinstance(label, torch.Tensor):
+        label = label.to(device=device, non_blocking=non_blocking)
+
+    return image, label
+
+
+def prepare_train_batch(batchdata, device=None, non_blocking=False):
+    """Same as prepare_batch, plus the random flips and noise of training.
+
+    Args:
+        batchdata (dict): Batch from the DataLoader.
+        device (torch.device, optional): Target device. Defaults to None.
+        non_blocking (bool, optional): Asynchronous copy. Defaults to False.
+
+    Returns:
+        tuple: (image, label) tensors.
+    """
+    image, label = prepare_batch(batchdata, device, non_blocking)
+    image, label = factory.augment_batch(image, label)
+
+    return image.contiguous(memory_format=torch.channels_last_3d), label
+
+
+def set_cudnn_flags(deterministic=True):
+    """Enable the cuDNN autotuner and TF32 kernels for the current process.
+
+    Must run after monai.utils.set_determinism, which turns benchmark off.
+
+    Args:
+        deterministic (bool, optional): Keep cuDNN restricted to deterministic
+            algorithms, as set by set_determinism (cfg.deterministic). Defaults to True.
+    """
+    # fixed input size (cfg.imgsize), so the autotuned algorithm is reused
+    torch.backends.cudnn.benchmark = True
+    if not deterministic:
+        # faster algorithms, but runs are no longer bit-for-bit reproducible
+        torch.backends.cudnn.deterministic = False
+    # TF32 tensor cores on Ampere+, no effect on older GPUs
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+    log(f"cuDNN benchmark: {torch.backends.cudnn.benchmark} | "
+        f"deterministic: {torch.backends.cudnn.deterministic}")
+
+
 def main():
     """Set the main configurations and run the mode specified.
 
@@ -73,7 +123,8 @@ def main():
     cfg = Config.fromfile(args.config)
 
     cfg.mode = args.mode
-    cfg.gpu = args.gpu
+    # one process per GPU when launched with torchrun
+    cfg.gpu = int(os.environ.get("LOCAL_RANK", args.gpu))
     cfg.snapshot = args.snapshot
     cfg.output = args.output
 
@@ -95,6 +146,10 @@ def main():
         log(f"Mode: {cfg.mode}")
         test(cfg)
 
+    elif cfg.mode == "preprocess":
+        log(f"Mode: {cfg.mode}")
+        preprocess(cfg)
+
     else:
         raise ValueError("Unknown mode.")
 
@@ -105,6 +160,7 @@ def train(cfg):
     Args:
         cfg (config file): Config file from model.
     """
+    set_cudnn_flags(cfg.get("deterministic", True))
 
     data = sorted(glob.glob(os.path.join(
         cfg.data.train.imgdir, "mri/*.nii.gz")))
@@ -119,9 +175,13 @@ def train(cfg):
     batch_size = cfg.batch_size
     log(f"Batch size: {batch_size}")
 
+    # folds are independent: with torchrun each rank trains its own folds
+    rank = int(os.environ.get("RANK", 0))
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+
     num_models = 5
     models = [_run_nn(cfg, dataset_splitted, keys, idx)
-              for idx in range(num_models)]
+              for idx in range(rank, num_models, world_size)]
 
 
 def _run_nn(cfg, dataset_splitted, keys, index):
@@ -160,7 +220,8 @@ def _run_nn(cfg, dataset_splitted, keys, index):
         keys, val_files, cfg.imgsize
     )
 
-    model = factory.get_model(cfg).to(DEVICE)
+    net = factory.get_model(cfg).to(DEVICE)
+    model = factory.compile_model(cfg, net, mode="reduce-overhead")
     optimizer = factory.get_optimizer(cfg, model.parameters())
     scheduler = factory.get_scheduler(cfg, optimizer, len(train_loader))
     criterion = factory.get_loss(cfg)
@@ -181,16 +242,20 @@ def _run_nn(cfg, dataset_splitted, keys, index):
         ProgressBar(),
         CheckpointSaver(save_dir=cfg.workdir,
                         file_prefix=f"{cfg.model_id}_fold{index}",
-                        save_dict={"model": model},
+                        # the eager module, so checkpoint keys do not depend on torch.compile
+                        save_dict={"model": net},
                         save_key_metric=True,
                         key_metric_n_saved=5),
     ]
 
     evaluator = monai.engines.SupervisedEvaluator(
         device=DEVICE,
+        non_blocking=True,
         val_data_loader=val_loader,
-        network=model,
-        inferer=factory.get_inferer(cfg.imgsize),
+        # shares the weights with the trained model
+        network=factory.compile_model(cfg, net),
+        prepare_batch=prepare_batch,
+        inferer=factory.get_inferer(cfg.imgsize, **cfg.inferer),
         post_transform=val_post_transform,
         key_val_metric={
             "val_mean_dice": MeanDice(include_background=False, output_transform=lambda x: (x["pred"], x["label"])),
@@ -208,12 +273,14 @@ def _run_nn(cfg, dataset_splitted, keys, index):
 
     trainer = monai.engines.SupervisedTrainer(
         device=DEVICE,
+        non_blocking=True,
         max_epochs=cfg.epochs,
         train_data_loader=train_loader,
         network=model,
         optimizer=optimizer,
         loss_function=criterion,
-        inferer=factory.get_inferer(cfg.imgsize),
+        prepare_batch=prepare_train_batch,
+        inferer=factory.get_inferer(cfg.imgsize, **cfg.inferer),
         key_train_metric=None,
         train_handlers=train_handlers,
         amp=cfg.amp,
@@ -225,11 +292,15 @@ def _run_nn(cfg, dataset_splitted, keys, index):
     return model
 
 
-def test(cfg):
-    """Perform evalutaion and save the segmentations.
+def _get_test_files(cfg, keys):
+    """List the test images and their masks.
 
-     Args:
+    Args:
         cfg (config file): Config file from model.
+        keys (tuple): dictionary keys used. E.g. ("image", "label").
+
+    Returns:
+        list: list of dicts with the image and label paths.
     """
     images = sorted(glob.glob(
         os.path.join(cfg.data.test.imgdir, "mri/*.nii.gz")))
@@ -238,9 +309,61 @@ def test(cfg):
 
     log(f"Testing: image/label ({len(images)}/{len(labels)}) folder: {cfg.data.test.imgdir}")
 
-    test_files = [{"image": img, "label": seg}
-                  for img, seg in zip(images, labels)]
+    return [{keys[0]: img, keys[1]: seg}
+            for img, seg in zip(images, labels)]
+
+
+def preprocess(cfg):
+    """Fill the preprocessing caches (cfg.data.*.cache_dir) ahead of time.
+
+    Loading, reorientation, resampling and intensity scaling then run once
+    per file here, instead of during the first epoch of every fold.
+
+    Args:
+        cfg (config file): Config file from model.
+    """
+    for name in ("train", "valid", "test"):
+        if not cfg.data[name].get("cache_dir"):
+            # without it the datasets are cached in memory only, and lost
+            raise ValueError(f"data.{name}.cache_dir is not set, nothing to preprocess.")
+
+    keys = ("image", "label")
+
+    data = sorted(glob.glob(os.path.join(
+        cfg.data.train.imgdir, "mri/*.nii.gz")))
+
+    # every file is used for training in some folds and validation in the others
+    train_files, val_files = SplitDataset(data, cfg.seed).get_data(
+        current_fold=0,
+        keys=keys,
+        path_to_masks_dir=os.path.join(cfg.data.valid.imgdir, "masks"),
+    )
+    train_files = train_files + val_files
+    test_files = _get_test_files(cfg, keys)
+
+    for data_cfg, mode, files in ((cfg.data.train, "train", train_files),
+                                  (cfg.data.valid, "val", train_files),
+                                  (cfg.data.test, "val", test_files)):
+        log(f"Caching {len(files)} files ({mode}) in {data_cfg.cache_dir}")
+
+        dataset = factory.get_dataloader(
+            data_cfg, mode, keys, files, cfg.imgsize).dataset
+        # one file per batch so that none is dropped (loader.drop_last)
+        for _ in tqdm(monai.data.DataLoader(
+                dataset, num_workers=data_cfg.loader.num_workers)):
+            pass
+
+
+def test(cfg):
+    """Perform evalutaion and save the segmentations.
+
+     Args:
+        cfg (config file): Config file from model.
+    """
+    set_cudnn_flags(cfg.get("deterministic", True))
+
     keys = ("image", "label")
+    test_files = _get_test_files(cfg, keys)
 
     # creating data loader
     val_loader = factory.get_dataloader(
@@ -259,12 +382,6 @@ def test(cfg):
 
         mean_post_transforms = monai.transforms.Compose(
             [
-                MeanEnsembled(
-                    keys=["pred0", "pred1", "pred2", "pred3", "pred4"],
-                    output_key="pred",
-                    # in this particular example, we use validation metrics as weights
-                    #weights=[0.95, 0.94, 0.95, 0.94, 0.90],
-                ),
                 AsDiscreted(keys=("pred", "label"),
                             argmax=(True, False),
                             to_onehot=True,
@@ -289,12 +406,16 @@ def ensemble_evaluate(cfg, post_transforms, loader, models):
         loader (DataLoader): torch test DataLoader.
         models ([list]): list of models with its respective checkpoints.
     """
-    evaluator = monai.engines.EnsembleEvaluator(
+    # all the models run on each window, so the volume is split and
+    # stitched by a single sliding-window pass instead of one per model
+    evaluator = monai.engines.SupervisedEvaluator(
         device=DEVICE,
+        non_blocking=True,
         val_data_loader=loader,
-        pred_keys=["pred0", "pred1", "pred2", "pred3", "pred4"],
-        networks=models,
-        inferer=factory.get_inferer(cfg.imgsize),
+        # compiled once as a whole, not once per checkpoint
+        network=factory.compile_model(cfg, factory.MeanEnsemble(models)),
+        prepare_batch=prepare_batch,
+        inferer=factory.get_inferer(cfg.imgsize, **cfg.inferer),
         post_transform=post_transforms,
         key_val_metric={
             "test_mean_dice": MeanDice(
@@ -302,13 +423,7 @@ def ensemble_evaluate(cfg, post_transforms, loader, models):
                 output_transform=lambda x: (x["pred"], x["label"]),
             )
         },
-        additional_metrics={
-            "test_hausdorff": HausdorffDistance(
-                include_background=False,
-                output_transform=lambda x: (x["pred"], x["label"])
-            )
-        },
-        amp=True,
+        amp=cfg.amp,
     )
 
     val_stats_handler = StatsHandler(
@@ -337,13 +452,60 @@ def ensemble_evaluate(cfg, post_transforms, loader, models):
 
     ).attach(evaluator)
 
+    # keep the (post-processed) segmentations, the Hausdorff distance is only
+    # computed once inference is over
+    segmentations = []
+    evaluator.add_event_handler(
+        Events.ITERATION_COMPLETED,
+        lambda engine: segmentations.extend(zip(
+            engine.state.batch["image_meta_dict"]["filename_or_obj"],
+            engine.state.output["pred"].bool().cpu(),
+            engine.state.output["label"].bool().cpu(),
+        )),
+    )
+
     evaluator.run()
 
+    hausdorff_evaluate(cfg, segmentations)
 
-if __name__ == "__main__":
-    torch.backends.cudnn.benchmark = True
-    log(torch.backends.cudnn.benchmark)
 
+def hausdorff_evaluate(cfg, segmentations):
+    """Hausdorff distance of the test segmentations, after inference.
+
+    Same values as the HausdorffDistance handler: computed on the evaluation
+    grid (1.25 x 1.25 x 5.0 spacing), in voxels, without the background.
+    The distance transforms run on CPU, so they no longer stall the GPU.
+    Written in the MetricsSaver format: test_hausdorff_raw.csv and a
+    test_hausdorff line in metrics.csv.
+
+    Args:
+        cfg (config file): Config file from model.
+        segmentations (list): (filename, one-hot pred, one-hot label) tuples.
+    """
+    filenames, distances = [], []
+    for filename, pred, label in tqdm(segmentations):
+        filenames.append(filename)
+        distances.append(compute_hausdorff_distance(
+            pred[None], label[None], include_background=False)[0])
+
+    distances = torch.stack(distances)
+
+    write_metrics_reports(
+        save_dir=cfg.prediction_folder,
+        images=filenames,
+        metrics=None,
+        metric_details={"test_hausdorff": distances},
+        summary_ops=None,
+        deli=",",
+    )
+    mean_distance = np.nanmean(distances.numpy())
+    with open(os.path.join(cfg.prediction_folder, "metrics.csv"), "a") as f:
+        f.write(f"test_hausdorff,{mean_distance}\n")
+
+    log(f"Test Hausdorff: {mean_distance}")
+
+
+if __name__ == "__main__":
     torch.cuda.empty_cache()
 
     try: